@@ -0,0 +1,369 @@
+r"""
+Benchmarks for ``graph_dynamics``.
+
+Time the update rules, the graph generators, ``color_randomly()``,
+``maslov_sneppen()``, ``run_rule()``, and ``run_rule_many_times()``
+on a ladder of graph sizes, on lattice and random graphs, directed and
+undirected, and report the time per call, per step (per run for
+``run_rule_many_times()``), and per edge and the peak memory allocated
+during a call.
+Runs without Sage, on the module's compiled graphs.
+
+Usage::
+
+    python benchmarks.py                         # sizes 10^3 to 10^5
+    python benchmarks.py --max-size 10000000     # the full ladder
+    python benchmarks.py --filter gsl --save baseline.json
+    python benchmarks.py --baseline baseline.json --tolerance 0.2
+
+With ``--baseline``, compare the times with those of a file saved by
+``--save`` and exit with status 1 if any benchmark got slower by more
+than the tolerance.
+Each benchmark has a largest size beyond which it is skipped, e.g. the
+dictionary-based update rules, which are timed on a ``PlainGraph``,
+stop at 10^6 vertices.
+"""
+from __future__ import division, print_function
+import argparse
+import gc
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+
+import graph_dynamics as gd
+
+
+SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+# (graph kind, directed) pairs; lattices are undirected
+KINDS = [('lattice', False), ('random', False), ('random', True)]
+MEAN_DEGREE = 8
+BIAS = {'green': 0.4, 'red': 0.4, 'yellow': 0.2}
+PALETTE = ['green', 'red', 'yellow']
+GSL3_KWARGS = dict(palette=PALETTE, T=0.5, t=0.25, s=0.25)
+GSL2_KWARGS = dict(palette=['green', 'red'], T=0.5)
+
+
+# Inputs ---------------------------------------------------------------------
+def lattice_shape(n):
+    r"""
+    Return the shape (r, c) of a nearly square lattice with about ``n``
+    vertices.
+    """
+    r = max(2, int(round(n**0.5)))
+    return r, max(2, n//r)
+
+def random_graph(n, directed=False, seed=0):
+    r"""
+    Return a random simple compiled graph on ``n`` vertices with about
+    ``MEAN_DEGREE*n//2`` edges between uniformly random vertices.
+    """
+    rng = np.random.default_rng(seed)
+    edges = rng.integers(0, n, size=(MEAN_DEGREE*n//2, 2))
+    # Drop loops and multiple edges
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    if not directed:
+        edges.sort(axis=1)
+    edges = np.unique(edges, axis=0)
+    return gd.compile_edges(n, edges, directed=directed)
+
+class Inputs(object):
+    r"""
+    The graph of the given kind and size and a random coloring of it,
+    as a dictionary and as codes, built on demand and then cached.
+    """
+    def __init__(self, kind, directed, n):
+        self.kind = kind
+        self.directed = directed
+        self.n = n
+        self._graph = None
+        self._coloring = None
+        self._codes = None
+
+    def graph(self):
+        if self._graph is None:
+            if self.kind == 'lattice':
+                r, c = lattice_shape(self.n)
+                self._graph = gd.moore_lattice(r, c, toroidal=True,
+                  output='compiled')
+            else:
+                self._graph = random_graph(self.n, self.directed)
+        return self._graph
+
+    def codes(self):
+        if self._codes is None:
+            self._codes, _ = gd.random_color_codes(self.graph().num_verts(),
+              BIAS, seed=1, palette=PALETTE)
+        return self._codes
+
+    def coloring(self):
+        if self._coloring is None:
+            self._coloring = gd.decode_coloring(self.graph(), self.codes(),
+              PALETTE)
+        return self._coloring
+
+    def num_edges(self):
+        return self.graph().num_edges()
+
+class PlainGraph(object):
+    r"""
+    The given compiled graph seen only through the methods of a Sage
+    graph, so that the update rules take their dictionary-based path.
+    """
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getattr__(self, name):
+        return getattr(self._graph, name)
+
+
+# Benchmarks -----------------------------------------------------------------
+# Each benchmark function takes an ``Inputs`` and returns the triple
+# (function to time, number of steps per call, number of edges).
+def rule_benchmark(rule, kwargs):
+    def benchmark(inputs):
+        # On a compiled graph the rule would call its array version
+        G, c = PlainGraph(inputs.graph()), inputs.coloring()
+        return (lambda: rule(G, c, **kwargs)), 1, inputs.num_edges()
+
+    return benchmark
+
+def subset_rule_benchmark(rule, kwargs, fraction=0.01):
+    def benchmark(inputs):
+        # Update a random 1% of the vertices, as an incremental step of
+        # ``run_rule()`` does once the dynamics have nearly stabilized
+        G, c = inputs.graph(), inputs.coloring()
+        n = G.num_verts()
+        rng = np.random.default_rng(0)
+        vertices = [G.labels[i] for i in rng.choice(n,
+          max(1, int(fraction*n)), replace=False)]
+        return ((lambda: rule(G, c, vertices=vertices, **kwargs)), 1,
+          inputs.num_edges())
+
+    return benchmark
+
+def array_rule_benchmark(rule, kwargs):
+    def benchmark(inputs):
+        G, codes = inputs.graph(), inputs.codes()
+        return (lambda: rule(G, codes, **kwargs)), 1, inputs.num_edges()
+
+    return benchmark
+
+def lattice_rule_benchmark(rule, kwargs):
+    def benchmark(inputs):
+        r, c = lattice_shape(inputs.n)
+        codes = inputs.codes().reshape(r, c)
+        return ((lambda: gd.lattice_rule_array(rule, kwargs, codes,
+          lattice='moore', toroidal=True)), 1, inputs.num_edges())
+
+    return benchmark
+
+def generator_benchmark(generator):
+    def benchmark(inputs):
+        r, c = lattice_shape(inputs.n)
+        return ((lambda: generator(r, c, toroidal=True, output='compiled')),
+          1, 4*r*c)
+
+    return benchmark
+
+def bench_preferential_attachment(inputs):
+    n = inputs.n
+    return ((lambda: gd.preferential_attachment_edges(n, BIAS, m=4, seed=0)),
+      1, 4*n)
+
+def bench_color_randomly(inputs):
+    G = inputs.graph()
+    return (lambda: gd.color_randomly(G, BIAS, seed=0)), 1, inputs.num_edges()
+
+def bench_maslov_sneppen(inputs):
+    G = inputs.graph()
+    m = inputs.num_edges()
+    return (lambda: gd.maslov_sneppen(G, num_steps=m, seed=0)), m, m
+
+def run_rule_benchmark(incremental):
+    def benchmark(inputs):
+        G, c = inputs.graph(), inputs.coloring()
+        num_steps = 10
+
+        def run():
+            s, stabilized = gd.run_rule(gd.majority_rule, {}, G, c,
+              num_steps=num_steps, incremental=incremental, record='final')
+            return len(s)
+
+        return run, num_steps, inputs.num_edges()
+
+    return benchmark
+
+def bench_run_rule_many_times(inputs):
+    num_runs = 10
+    kwargs = dict(n=inputs.n, directed=inputs.directed)
+
+    def run():
+        gd.run_rule_many_times(gd.gsl3_rule, GSL3_KWARGS,
+          random_graph, kwargs, gd.color_randomly, {'bias': BIAS},
+          num_steps=10, num_runs=num_runs, print_stats=False, seed=0)
+
+    return run, num_runs, inputs.num_edges()
+
+# Name -> (benchmark function, graph kinds, largest size)
+BENCHMARKS = [
+  ('majority_rule', rule_benchmark(gd.majority_rule, {}), KINDS, 10**6),
+  ('plurality_rule', rule_benchmark(gd.plurality_rule, {}), KINDS, 10**6),
+  ('gsl2_rule', rule_benchmark(gd.gsl2_rule, GSL2_KWARGS), KINDS, 10**6),
+  ('gsl3_rule', rule_benchmark(gd.gsl3_rule, GSL3_KWARGS), KINDS, 10**6),
+  ('majority_rule_subset', subset_rule_benchmark(gd.majority_rule, {}),
+    KINDS, 10**7),
+  ('majority_rule_array', array_rule_benchmark(gd.majority_rule_array, {}),
+    KINDS, 10**7),
+  ('plurality_rule_array',
+    array_rule_benchmark(gd.plurality_rule_array, {}), KINDS, 10**7),
+  ('gsl2_rule_array', array_rule_benchmark(gd.gsl2_rule_array,
+    dict(T=0.5)), KINDS, 10**7),
+  ('gsl3_rule_array', array_rule_benchmark(gd.gsl3_rule_array,
+    dict(T=0.5, t=0.25, s=0.25)), KINDS, 10**7),
+  ('lattice_rule_array', lattice_rule_benchmark(gd.majority_rule_array, {}),
+    [('lattice', False)], 10**7),
+  ('moore_lattice', generator_benchmark(gd.moore_lattice),
+    [('lattice', False)], 10**7),
+  ('triangular_lattice', generator_benchmark(gd.triangular_lattice),
+    [('lattice', False)], 10**7),
+  ('preferential_attachment', bench_preferential_attachment,
+    [('random', False)], 10**7),
+  ('color_randomly', bench_color_randomly, [('random', False)], 10**7),
+  ('maslov_sneppen', bench_maslov_sneppen, KINDS[1:], 10**6),
+  ('run_rule', run_rule_benchmark(False), KINDS, 10**6),
+  ('run_rule_incremental', run_rule_benchmark(True), KINDS, 10**6),
+  ('run_rule_many_times', bench_run_rule_many_times, KINDS[1:], 10**5),
+]
+# Benchmarks whose "steps" are whole runs
+PER_RUN = {'run_rule_many_times'}
+
+
+# Measuring ------------------------------------------------------------------
+def peak_memory(fn):
+    r"""
+    Return the peak number of bytes allocated during a call of ``fn``,
+    as traced by ``tracemalloc``.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(fn, num_steps, num_edges, repeat=3, memory=True, unit='step'):
+    r"""
+    Return a dictionary of the best time of ``repeat`` calls of ``fn``
+    in seconds, that time per step (or per ``unit``) and per edge, and, 
+    if ``memory == True``, the peak memory of a separate call in bytes.
+    """
+    seconds = min(timeit.repeat(fn, number=1, repeat=repeat))
+    result = {
+      'seconds': seconds,
+      'seconds_per_' + unit: seconds/num_steps,
+      'seconds_per_edge': seconds/max(num_edges, 1),
+    }
+    if memory:
+        result['peak_bytes'] = peak_memory(fn)
+    return result
+
+def run(sizes, name_filter=None, repeat=3, memory=True):
+    r"""
+    Run the benchmarks on the given sizes and return a dictionary of
+    results keyed by 'name/kind/directedness/size'.
+    """
+    results = {}
+    for n in sizes:
+        inputs = {kind: Inputs(kind[0], kind[1], n) for kind in KINDS}
+        for name, benchmark, kinds, max_size in BENCHMARKS:
+            if n > max_size or (name_filter and name_filter not in name):
+                continue
+            for kind in kinds:
+                key = '{!s}/{!s}/{!s}/{!s}'.format(name, kind[0],
+                  'directed' if kind[1] else 'undirected', n)
+                fn, num_steps, num_edges = benchmark(inputs[kind])
+                results[key] = measure(fn, num_steps, num_edges, repeat,
+                  memory, 'run' if name in PER_RUN else 'step')
+                print_result(key, results[key])
+    return results
+
+def print_result(key, result):
+    unit = 'run' if 'seconds_per_run' in result else 'step'
+    line = '{:<55} {:>10.4g} s {:>10.3g} s/{:<4} {:>10.3g} s/edge'.format(
+      key, result['seconds'], result['seconds_per_' + unit], unit,
+      result['seconds_per_edge'])
+    if 'peak_bytes' in result:
+        line += ' {:>10.1f} MB'.format(result['peak_bytes']/1e6)
+    print(line)
+    sys.stdout.flush()
+
+def compare(results, baseline, tolerance):
+    r"""
+    Print the ratios of the times of the given results to those of the
+    baseline results, and return the list of keys of the benchmarks
+    that got slower by more than the given fraction.
+    """
+    slower = []
+    print()
+    print('{:<55} {:>10} {:>10} {:>8}'.format('benchmark', 'baseline', 'now',
+      'ratio'))
+    for key in sorted(set(results) & set(baseline)):
+        old = baseline[key]['seconds']
+        new = results[key]['seconds']
+        ratio = new/old if old else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  slower'
+            slower.append(key)
+        elif ratio < 1/(1 + tolerance):
+            flag = '  faster'
+        print('{:<55} {:>10.4g} {:>10.4g} {:>8.2f}{!s}'.format(key, old, new,
+          ratio, flag))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark graph_dynamics.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+      help='graph sizes (numbers of vertices)')
+    parser.add_argument('--max-size', type=int, default=10**5,
+      help='skip sizes above this')
+    parser.add_argument('--filter', default=None,
+      help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=3,
+      help='number of timed calls, of which the best is kept')
+    parser.add_argument('--no-memory', action='store_true',
+      help='skip measuring peak memory')
+    parser.add_argument('--save', default=None,
+      help='save the results to this JSON file')
+    parser.add_argument('--baseline', default=None,
+      help='compare the results with those in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+      help='fraction by which a benchmark may get slower')
+    args = parser.parse_args(argv)
+
+    sizes = [n for n in args.sizes if n <= args.max_size]
+    results = run(sizes, args.filter, args.repeat, not args.no_memory)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'machine': platform.platform(),
+              'results': results,
+            }, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = compare(results, baseline, args.tolerance)
+        if slower:
+            print('{!s} benchmarks got slower'.format(len(slower)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
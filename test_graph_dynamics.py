@@ -0,0 +1,1088 @@
+r"""
+Unit tests for ``graph_dynamics``.
+
+The vectorized paths (array update rules, compiled rules, lattice
+stencils, and the batch, parallel, and asynchronous drivers) are checked
+against the dictionary-based update rules, which run on graphs that are
+not compiled, on small random directed and undirected graphs with loops.
+Run with ``python -m pytest test_graph_dynamics.py``.
+"""
+from __future__ import division, print_function
+import os
+
+import numpy as np
+import pytest
+
+import graph_dynamics as gd
+from graph_dynamics import MAX
+
+
+# Fixtures -------------------------------------------------------------------
+RULES = [
+  (gd.majority_rule, {}, ['a', 'b', 'c']),
+  (gd.plurality_rule, {}, ['a', 'b', 'c']),
+  (gd.gsl2_rule, {'T': 0.4}, ['green', 'yellow']),
+  (gd.gsl3_rule, {'T': 0.5, 't': 0.3, 's': 0.2}, ['green', 'red', 'yellow']),
+]
+RULE_IDS = ['majority', 'plurality', 'gsl2', 'gsl3']
+
+def random_edges(n, p, directed=False, loops=True, rng=None):
+    r"""
+    Return the array of edges of a random graph on ``n`` vertices with
+    each edge (and loop if ``loops == True``) present with probability
+    ``p``, drawn from ``rng`` or NumPy's global generator.
+    """
+    rng = rng if rng is not None else np.random
+    edges = np.argwhere(rng.random_sample((n, n)) < p)
+    if not directed:
+        edges = edges[edges[:, 0] <= edges[:, 1]]
+    if not loops:
+        edges = edges[edges[:, 0] != edges[:, 1]]
+    return edges
+
+def random_graph(n=20, p=0.2, directed=False):
+    r"""
+    Return a random compiled graph with loops, as a graph generator for
+    ``run_rule_many_times()``, which seeds NumPy's global generator.
+    """
+    return gd.compile_edges(n, random_edges(n, p, directed), directed)
+
+def random_coloring(G, palette, rng):
+    codes = rng.randint(len(palette), size=G.num_verts())
+    return {v: palette[i] for v, i in zip(G.labels, codes)}
+
+class SageLikeGraph(object):
+    r"""
+    A graph that is not compiled, with the methods of a Sage graph that
+    the update rules use, taken from the given compiled graph.
+    """
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getattr__(self, name):
+        return getattr(self._graph, name)
+
+def dict_rule(rule):
+    r"""
+    Return the given update rule restricted to its dictionary-based path,
+    by always passing it ``vertices`` and a graph that is not compiled.
+    """
+    def update(graph, coloring, vertices=None, **kwargs):
+        if vertices is None:
+            vertices = list(graph.vertex_iterator())
+        return rule(SageLikeGraph(graph), coloring, vertices=vertices,
+          **kwargs)
+
+    return update
+
+def graphs(num_graphs=6, seed=0):
+    r"""
+    Yield the pairs (random number generator, compiled graph) of
+    ``num_graphs`` small random graphs, alternately undirected and directed.
+    """
+    rng = np.random.RandomState(seed)
+    for k in range(num_graphs):
+        directed = k % 2 == 1
+        n = rng.randint(1, 40)
+        edges = random_edges(n, rng.uniform(0.02, 0.3), directed, rng=rng)
+        yield rng, gd.compile_edges(n, edges, directed)
+
+def compiled_spec(rule, kwargs, palette):
+    r"""
+    Return the pair (clauses, counted) of ``compile_rule()`` that
+    describes the given built-in rule.
+    """
+    P = palette
+    if rule is gd.majority_rule:
+        return [(None, [('fraction', MAX, '>', 0.5)], MAX)], None
+    if rule is gd.plurality_rule:
+        return [(None, [('count', MAX, '>', 1)], MAX)], None
+    if rule is gd.gsl2_rule:
+        return [(None, [('fraction', P[0], '>', kwargs['T'])], P[0])], P
+    T, t, s = kwargs['T'], kwargs['t'], kwargs['s']
+    return [
+      (None, [('fraction', P[0], '>', T)], P[0]),
+      (None, [('fraction', P[1], '>', T)], P[1]),
+      (P[0], [('fraction', P[0], '<', t), ('fraction', P[1], '>=', s)], P[2]),
+      (P[1], [('fraction', P[1], '<', t), ('fraction', P[0], '>=', s)], P[2]),
+    ], None
+
+def rule_kwargs(rule, kwargs, palette):
+    r"""
+    Return the keyword arguments of the given rule with the palette
+    added for the GSL rules.
+    """
+    if rule in (gd.gsl2_rule, gd.gsl3_rule):
+        return dict(kwargs, palette=palette)
+    return dict(kwargs)
+
+
+# Random colorings -----------------------------------------------------------
+BIAS = {'a': 0.5, 'b': 0.3, 'c': 0.2}
+
+def test_random_color_codes():
+    codes, palette = gd.random_color_codes(20000, BIAS, seed=1)
+    assert palette == ['a', 'b', 'c'] and codes.dtype == np.uint8
+    frequencies = np.bincount(codes, minlength=3)/len(codes)
+    assert np.allclose(frequencies, [0.5, 0.3, 0.2], atol=0.02)
+    again, _ = gd.random_color_codes(20000, BIAS, seed=1)
+    assert (again == codes).all()
+    other, _ = gd.random_color_codes(20000, BIAS, seed=2)
+    assert (other != codes).any()
+    codes, palette = gd.random_color_codes(100, BIAS, seed=1,
+      palette=['c', 'd', 'b', 'a'], num_colorings=3)
+    assert palette == ['c', 'd', 'b', 'a'] and codes.shape == (3, 100)
+    assert not (codes == 1).any()
+    # Many colors take another path
+    many = {k: 1/20 for k in range(20)}
+    codes, palette = gd.random_color_codes(20000, many, seed=1)
+    assert np.allclose(np.bincount(codes, minlength=20)/len(codes), 1/20,
+      atol=0.01)
+    with pytest.raises(AssertionError):
+        gd.random_color_codes(10, {'a': 0.5, 'b': 0.6})
+
+def test_exact_color_codes():
+    counts = {'a': 5, 'b': 0, 'c': 7}
+    codes, palette = gd.exact_color_codes(counts, seed=1)
+    assert palette == ['a', 'b', 'c']
+    assert np.bincount(codes, minlength=3).tolist() == [5, 0, 7]
+    assert (gd.exact_color_codes(counts, seed=1)[0] == codes).all()
+    codes, _ = gd.exact_color_codes(counts, seed=1, num_colorings=20)
+    assert codes.shape == (20, 12)
+    assert (np.sort(codes, axis=1) == np.sort(codes[0])).all()
+    assert len(set(map(tuple, codes.tolist()))) > 1
+
+def test_color_randomly_and_exactly():
+    G = gd.compile_edges(100, random_edges(100, 0.05))
+    c = gd.color_randomly(G, BIAS, seed=3)
+    assert set(c) == set(G.labels) and set(c.values()) <= set(BIAS)
+    assert gd.color_randomly(G, BIAS, seed=3) == c
+    # Unseeded colorings follow the seeding of run_rule_many_times()
+    gd._seed_random_generators(4)
+    c = gd.color_randomly(G, BIAS)
+    gd._seed_random_generators(4)
+    assert gd.color_randomly(G, BIAS) == c
+    c = gd.color_exactly(G, {'a': 60, 'b': 40}, seed=3)
+    assert sorted(gd.color_count(c).items()) == [('a', 60), ('b', 40)]
+    assert gd.color_exactly(G, {'a': 60, 'b': 40}, seed=3) == c
+    with pytest.raises(AssertionError):
+        gd.color_exactly(G, {'a': 60, 'b': 41})
+
+def test_color():
+    G = gd.compile_edges(4, np.array([[0, 1], [2, 3]]))
+    assert gd.color(G, 'abba') == {0: 'a', 1: 'b', 2: 'b', 3: 'a'}
+    with pytest.raises(AssertionError):
+        gd.color(G, 'abc')
+
+
+# Update rules ---------------------------------------------------------------
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_array_path_matches_dict_path(rule, kwargs, palette):
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs():
+        for _ in range(3):
+            c = random_coloring(G, palette, rng)
+            new = rule(G, c, **kwargs)
+            assert isinstance(new, gd.Coloring)
+            assert dict(new) == dict_rule(rule)(G, c, **kwargs)
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_array_rules_on_batches(rule, kwargs, palette):
+    array_rule, array_kwargs = gd._as_array_rule(rule, kwargs)
+    for rng, G in graphs():
+        colorings = [random_coloring(G, palette, rng) for _ in range(3)]
+        codes = np.array([gd.encode_coloring(G, c, palette)[0]
+          for c in colorings])
+        if array_rule in (gd.majority_rule_array, gd.plurality_rule_array):
+            array_kwargs['num_colors'] = len(palette)
+        new_codes = array_rule(G, codes, **array_kwargs)
+        for c, row in zip(colorings, new_codes):
+            expected = dict_rule(rule)(G, c, **rule_kwargs(rule, kwargs,
+              palette))
+            assert gd.decode_coloring(G, row, palette) == expected
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_compiled_rules_match_dict_rules(rule, kwargs, palette):
+    clauses, counted = compiled_spec(rule, kwargs, palette)
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs():
+        max_degree = int(G.in_degrees().max()) if G.num_verts() else 0
+        for table in (None, max_degree):
+            compiled = gd.compile_rule(clauses, palette=palette,
+              counted=counted, max_degree=table)
+            c = random_coloring(G, palette, rng)
+            expected = dict_rule(rule)(G, c, **kwargs)
+            assert dict(compiled(G, c)) == expected
+            some = list(G.labels)[::3]
+            assert compiled(G, c, vertices=some) ==\
+              {v: expected[v] for v in some}
+            assert compiled(G, gd.Coloring.from_dict(G, c), vertices=some)\
+              == {v: expected[v] for v in some}
+    # Compiled rules also run on lattice stencils and in batches
+    G = gd.moore_lattice(4, 7, toroidal=True, output='compiled')
+    codes = np.random.RandomState(8).randint(len(palette), size=(2, 4, 7))
+    compiled = gd.compile_rule(clauses, palette=palette, counted=counted)
+    new_codes = gd.lattice_rule_array(compiled, {}, codes[0],
+      toroidal=True)
+    expected = dict_rule(rule)(G, gd.decode_coloring(G, codes[0].ravel(),
+      palette), **kwargs)
+    assert gd.decode_coloring(G, new_codes.ravel(), palette) == expected
+    batch, _, _ = gd.run_rule_batch(compiled, {}, G, codes.reshape(2, -1),
+      num_steps=1)
+    assert (batch[0] == new_codes.ravel()).all()
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_rules_on_some_vertices(rule, kwargs, palette):
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs():
+        c = random_coloring(G, palette, rng)
+        new = rule(SageLikeGraph(G), c, **kwargs)
+        some = list(G.labels)[::3]
+        assert rule(G, c, vertices=some, **kwargs) ==\
+          {v: new[v] for v in some}
+        assert rule(G, gd.Coloring.from_dict(G, c), vertices=some,
+          **kwargs) == {v: new[v] for v in some}
+        assert rule(G, c, vertices=[], **kwargs) == {}
+
+class CountingDict(dict):
+    r"""
+    A dictionary that counts the reads of its items.
+    """
+    num_reads = 0
+
+    def __getitem__(self, key):
+        self.num_reads += 1
+        return dict.__getitem__(self, key)
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_rules_on_some_vertices_read_only_their_neighbors(rule, kwargs,
+  palette):
+    clauses, counted = compiled_spec(rule, kwargs, palette)
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    G = gd.moore_lattice(30, 30, toroidal=True, output='compiled')
+    c = CountingDict(random_coloring(G, palette, np.random.RandomState(0)))
+    some = [(0, 0), (10, 10), (10, 11)]
+    new = rule(G, c, vertices=some, **kwargs)
+    assert new == dict_rule(rule)(G, c, vertices=some, **kwargs)
+    c.num_reads = 0
+    rule(G, c, vertices=some, **kwargs)
+    # The 3 x 3 block around (0, 0) and the 3 x 4 block around the others
+    assert c.num_reads == 9 + 12
+    compiled = gd.compile_rule(clauses, palette=palette, counted=counted)
+    c.num_reads = 0
+    assert compiled(G, c, vertices=some) == new
+    assert c.num_reads == 9 + 12
+
+def test_out_neighbors():
+    for rng, G in graphs():
+        for v in G.labels:
+            out = sorted(G.neighbor_out_iterator(v))
+            assert out == sorted(u for u in G.labels
+              for w in G.neighbor_in_iterator(u) if w == v)
+
+def test_compile_graph():
+    for rng, G in graphs():
+        H = gd.compile_graph(SageLikeGraph(G))
+        assert list(H.labels) == list(G.labels)
+        assert H.is_directed() == G.is_directed()
+        assert (H.indptr == G.indptr).all() and (H.indices == G.indices).all()
+        assert gd.compile_graph(H) is H
+
+def test_encode_coloring():
+    for rng, G in graphs():
+        c = random_coloring(G, ['a', 'b', 'c'], rng)
+        codes, palette = gd.encode_coloring(G, c, ['c', 'd'])
+        assert palette[:2] == ['c', 'd']
+        assert set(palette) <= {'a', 'b', 'c', 'd'}
+        assert codes.dtype == np.uint8
+        assert gd.decode_coloring(G, codes, palette) == c
+
+def test_run_rule_compiles_graph_once_for_compiled_rules(monkeypatch):
+    compile_graph = gd.compile_graph
+    compiled = []
+
+    def counted_compile_graph(graph):
+        if not isinstance(graph, gd.CompiledGraph):
+            compiled.append(graph)
+        return compile_graph(graph)
+
+    monkeypatch.setattr(gd, 'compile_graph', counted_compile_graph)
+    rule = gd.compile_rule([(None, [('count', MAX, '>', 1)], MAX)])
+    rng = np.random.RandomState(7)
+    G = gd.compile_edges(30, random_edges(30, 0.2, rng=rng))
+    c = random_coloring(G, ['a', 'b', 'c'], rng)
+    s, stabilized = gd.run_rule(gd.plurality_rule, {}, G, c, num_steps=10)
+    for incremental in [False, True]:
+        del compiled[:]
+        out, out_stabilized = gd.run_rule(rule, {}, SageLikeGraph(G), c,
+          num_steps=10, incremental=incremental)
+        assert len(compiled) == 1
+        assert list(out) == s and out_stabilized == stabilized
+
+def test_neighbor_color_counts():
+    for rng, G in graphs():
+        codes = rng.randint(3, size=G.num_verts())
+        counts = gd.neighbor_color_counts(G, codes, 3)
+        for i, v in enumerate(G.labels):
+            for u in G.neighbor_in_iterator(v):
+                counts[codes[G.vertex_index(u)], i] -= 1
+        assert not counts.any()
+        batch = np.array([codes, codes[::-1]])
+        counts = gd.neighbor_color_counts(G, batch, 3)
+        assert (counts[:, 0] == gd.neighbor_color_counts(G, codes, 3)).all()
+        assert (counts[:, 1] ==
+          gd.neighbor_color_counts(G, codes[::-1].copy(), 3)).all()
+
+
+@pytest.mark.parametrize('lattice', ['moore', 'triangular'])
+@pytest.mark.parametrize('toroidal', [False, True])
+def test_lattice_color_counts(lattice, toroidal):
+    generator = gd.moore_lattice if lattice == 'moore' else\
+      gd.triangular_lattice
+    rng = np.random.RandomState(0)
+    for r, c in [(4, 3), (4, 7), (6, 5)]:
+        G = generator(r, c, toroidal=toroidal, output='compiled')
+        codes = rng.randint(3, size=(r, c))
+        counts = gd.lattice_color_counts(codes, 3, lattice=lattice,
+          toroidal=toroidal)
+        expected = gd.neighbor_color_counts(G, codes.ravel(), 3)
+        assert (counts.reshape(3, -1) == expected).all()
+
+@pytest.mark.parametrize('lattice', ['moore', 'triangular'])
+@pytest.mark.parametrize('toroidal', [False, True])
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_lattice_stencils_match_dict_rules(rule, kwargs, palette, lattice,
+  toroidal):
+    generator = gd.moore_lattice if lattice == 'moore' else\
+      gd.triangular_lattice
+    rng = np.random.RandomState(1)
+    for r, c in [(4, 3), (4, 7), (6, 5)]:
+        G = generator(r, c, toroidal=toroidal, output='compiled')
+        codes = rng.randint(len(palette), size=(r, c))
+        coloring = gd.decode_coloring(G, codes.ravel(), palette)
+        expected = dict_rule(rule)(G, coloring, **rule_kwargs(rule, kwargs,
+          palette))
+        new_codes = gd.lattice_rule_array(rule, kwargs, codes,
+          lattice=lattice, toroidal=toroidal)
+        assert gd.decode_coloring(G, new_codes.ravel(), palette) == expected
+
+# Run drivers ----------------------------------------------------------------
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_incremental_run_matches_full_run(rule, kwargs, palette):
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs():
+        c = random_coloring(G, palette, rng)
+        c0 = dict(c)
+        s, stabilized = gd.run_rule(dict_rule(rule), kwargs, G, c,
+          num_steps=20)
+        for record in ['all', 'final', 'delta', 2]:
+            out, out_stabilized = gd.run_rule(rule, kwargs, G, c,
+              num_steps=20, incremental=True, record=record)
+            assert out_stabilized == stabilized
+            assert len(out) == len(s)
+            assert out[0] == s[0] and out[-1] == s[-1]
+        assert c == c0
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_recording_modes(incremental):
+    for rng, G in graphs():
+        c = random_coloring(G, ['a', 'b', 'c'], rng)
+        s, stabilized = gd.run_rule(gd.plurality_rule, {}, G, c,
+          num_steps=20)
+        for record in ['all', 'final', 'delta', 1, 3]:
+            seen = []
+            out, out_stabilized = gd.run_rule(gd.plurality_rule, {}, G, c,
+              num_steps=20, incremental=incremental, record=record,
+              callback=lambda i, x: seen.append((i, dict(x))))
+            assert out_stabilized == stabilized and len(out) == len(s)
+            assert seen == list(enumerate(s))
+            if record == 'delta':
+                assert out.deltas == [{v: b[v] for v in b if a[v] != b[v]}
+                  for a, b in zip(s, s[1:])]
+            if record in ['all', 'delta', 1]:
+                assert [dict(x) for x in out] == s
+                assert [out[i] for i in range(-len(s), len(s))] == s + s
+            else:
+                every = 3 if record == 3 else len(s)
+                steps = sorted(set(range(0, len(s), every)) | {len(s) - 1})
+                assert list(out) == [s[i] for i in steps]
+                if len(s) > 2:
+                    # Not stored
+                    with pytest.raises(KeyError):
+                        out[1]
+    with pytest.raises(AssertionError):
+        gd.run_rule(gd.plurality_rule, {}, G, c, record='some')
+    with pytest.raises(AssertionError):
+        gd.run_rule(gd.plurality_rule, {}, G, c, record=True)
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_cycle_detection(rule, kwargs, palette):
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs():
+        c = random_coloring(G, palette, rng)
+        s, stabilized = gd.run_rule(dict_rule(rule), kwargs, G, c,
+          num_steps=30)
+        for detect_cycles in [True, 2]:
+            for incremental in [False, True]:
+                out, out_stabilized, cycle = gd.run_rule(rule, kwargs, G, c,
+                  num_steps=30, incremental=incremental,
+                  detect_cycles=detect_cycles)
+                if cycle is None:
+                    assert list(out) == s
+                    continue
+                transient, period = cycle
+                assert list(out) == s[:transient + period]
+                assert out_stabilized == (period == 1)
+                # The next coloring repeats the start of the cycle
+                assert dict_rule(rule)(G, out[-1], **kwargs) ==\
+                  out[transient]
+
+def test_cycle_of_period_two():
+    G = gd.compile_edges(2, np.array([[0, 1]]))
+    s, stabilized, cycle = gd.run_rule(gd.majority_rule, {}, G,
+      {0: 'a', 1: 'b'}, num_steps=10, detect_cycles=True)
+    assert not stabilized and cycle == (0, 2) and len(s) == 2
+
+def test_coloring_fingerprint():
+    rng = np.random.RandomState(1)
+    c = {v: rng.choice(['a', 'b']) for v in range(50)}
+    assert gd.coloring_fingerprint(c) ==\
+      gd.coloring_fingerprint(dict(reversed(list(c.items()))))
+    # Swapping two colors changes the fingerprint
+    swapped = dict(c)
+    u, v = [x for x in c if c[x] == 'a'][0], [x for x in c if c[x] == 'b'][0]
+    swapped[u], swapped[v] = c[v], c[u]
+    assert gd.coloring_fingerprint(swapped) != gd.coloring_fingerprint(c)
+    changes = {u: 'b', 3: 'c'}
+    new = dict(c)
+    new.update(changes)
+    assert gd._update_fingerprint(gd.coloring_fingerprint(c), c, changes) ==\
+      gd.coloring_fingerprint(new)
+    # A Coloring has the fingerprint of its dictionary, and hashes it
+    for G in [gd.compile_edges(50, np.array([[0, 1]])),
+      gd.moore_lattice(5, 10, output='compiled')]:
+        d = dict(zip(G.labels, c.values()))
+        x = gd.Coloring.from_dict(G, d, palette=['c', 'b', 'a'])
+        assert gd.coloring_fingerprint(x) == gd.coloring_fingerprint(d)
+        assert hash(x) == hash(gd.coloring_fingerprint(d))
+
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_run_rule_batch(rule, kwargs, palette):
+    for rng, G in graphs():
+        colorings = [random_coloring(G, palette, rng) for _ in range(4)]
+        codes = np.array([gd.encode_coloring(G, c, palette)[0]
+          for c in colorings]).reshape(4, -1)
+        new_codes, stabilized, num_changes = gd.run_rule_batch(rule,
+          kwargs, G, codes, num_steps=15)
+        for k, c in enumerate(colorings):
+            s, st = gd.run_rule(dict_rule(rule), rule_kwargs(rule, kwargs,
+              palette), G, c, num_steps=15)
+            assert gd.decode_coloring(G, new_codes[k], palette) == s[-1]
+            assert stabilized[k] == st
+            assert num_changes[k] == len(s) - 1
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES[1:2] + RULES[3:],
+  ids=['plurality', 'gsl3'])
+def test_run_lattice_rule(rule, kwargs, palette):
+    rng = np.random.RandomState(2)
+    G = gd.moore_lattice(6, 7, toroidal=True, output='compiled')
+    codes = rng.randint(len(palette), size=(6, 7))
+    new_codes, stabilized, num_changes = gd.run_lattice_rule(rule, kwargs,
+      codes, toroidal=True, num_steps=15)
+    s, st = gd.run_rule(dict_rule(rule), rule_kwargs(rule, kwargs, palette),
+      G, gd.decode_coloring(G, codes.ravel(), palette), num_steps=15)
+    assert gd.decode_coloring(G, new_codes.ravel(), palette) == s[-1]
+    assert stabilized == st and num_changes == len(s) - 1
+
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_run_rule_parallel(rule, kwargs, palette):
+    for rng, G in graphs(num_graphs=2):
+        c = random_coloring(G, palette, rng)
+        codes = gd.encode_coloring(G, c, palette)[0]
+        s, stabilized = gd.run_rule(dict_rule(rule), rule_kwargs(rule,
+          kwargs, palette), G, c, num_steps=15)
+        new_codes, st, num_changes = gd.run_rule_parallel(rule, kwargs, G,
+          codes, num_steps=15, num_workers=2)
+        assert new_codes.dtype == codes.dtype
+        assert gd.decode_coloring(G, new_codes, palette) == s[-1]
+        assert st == stabilized and num_changes == len(s) - 1
+
+def test_balanced_ranges():
+    indptr = np.cumsum([0] + [10, 0, 0, 0, 0, 0, 0, 0, 0, 0, 10])
+    boundaries = gd._balanced_ranges(indptr, 2)
+    assert boundaries == [0, 6, 11]
+    assert gd._balanced_ranges(indptr, 20)[::20] == [0, 11]
+    assert gd._balanced_ranges(np.zeros(1, dtype=int), 3) == [0, 0, 0, 0]
+
+@pytest.mark.parametrize('schedule', ['random', 'gillespie'])
+@pytest.mark.parametrize('rule,kwargs,palette', RULES, ids=RULE_IDS)
+def test_run_rule_async(rule, kwargs, palette, schedule):
+    kwargs = rule_kwargs(rule, kwargs, palette)
+    for rng, G in graphs(num_graphs=4):
+        c = random_coloring(G, palette, rng)
+        previous, previous_time = c, 0
+        for e in range(1, 15):
+            new, stabilized, num_events, time = gd.run_rule_async(rule,
+              kwargs, G, c, schedule=schedule, num_events=e, seed=3)
+            assert time >= previous_time
+            if num_events < e:
+                # No vertex can change color
+                assert stabilized and new == previous
+                assert dict_rule(rule)(G, new, **kwargs) == new
+                break
+            # Each event changes one vertex as the rule says
+            changed = [v for v in new if new[v] != previous[v]]
+            assert len(changed) == 1
+            assert dict_rule(rule)(G, previous, vertices=changed,
+              **kwargs) == {changed[0]: new[changed[0]]}
+            previous, previous_time = new, time
+
+def test_run_rule_async_max_time():
+    G = random_graph(30, 0.2)
+    c = gd.color_randomly(G, {'a': 0.5, 'b': 0.5}, seed=1)
+    new, stabilized, num_events, time = gd.run_rule_async(gd.plurality_rule,
+      {}, G, c, schedule='gillespie', max_time=0.01, seed=1)
+    assert time <= 0.01
+
+
+# Graph generators -----------------------------------------------------------
+LATTICE_SIZES = [(2, 2), (2, 5), (4, 2), (4, 5), (3, 6)]
+
+def lattice_edge_set(r, c, toroidal, lattice):
+    r"""
+    Return the set of edges of the given lattice graph as built vertex by
+    vertex by the original Sage generators.
+    """
+    edges = set()
+    for i in range(r):
+        for j in range(c):
+            if lattice == 'moore':
+                steps = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                  if (di, dj) != (0, 0)]
+            else:
+                odd = i % 2
+                steps = [(0, 1), (-1, 1 - odd), (-1, -odd), (0, -1),
+                  (1, -odd), (1, 1 - odd)]
+            for di, dj in steps:
+                ii, jj = i + di, j + dj
+                if toroidal:
+                    ii, jj = ii % r, jj % c
+                elif not (0 <= ii < r and 0 <= jj < c):
+                    continue
+                edges.add(frozenset([(i, j), (ii, jj)]))
+    return edges
+
+@pytest.mark.parametrize('lattice', ['moore', 'triangular'])
+@pytest.mark.parametrize('toroidal', [False, True])
+def test_lattice_generators(lattice, toroidal):
+    generator = gd.moore_lattice if lattice == 'moore' else\
+      gd.triangular_lattice
+    for r, c in LATTICE_SIZES:
+        if lattice == 'triangular' and toroidal and r % 2:
+            with pytest.raises(AssertionError):
+                generator(r, c, toroidal, output='edges')
+            continue
+        expected = lattice_edge_set(r, c, toroidal, lattice)
+        edges = generator(r, c, toroidal, output='edges')
+        assert edges.shape == (len(expected), 2)
+        assert {frozenset([divmod(u, c), divmod(v, c)])
+          for u, v in edges.tolist()} == expected
+        G = generator(r, c, toroidal, output='compiled')
+        assert list(G.vertex_iterator()) == [(i, j) for i in range(r)
+          for j in range(c)]
+        assert {frozenset([u, v]) for u in G.vertex_iterator()
+          for v in G.neighbor_iterator(u)} == expected
+        assert G.get_pos()[(1, 1)] == (1, -1)
+        if toroidal:
+            assert G.in_degrees().max() <= (8 if lattice == 'moore' else 6)
+
+@pytest.mark.parametrize('directed', [False, True])
+def test_maslov_sneppen_invariants(directed):
+    rng = np.random.RandomState(3)
+    n = 60
+    edges = random_edges(n, 0.1, directed, loops=False, rng=rng)
+    new, stats = gd.maslov_sneppen_edges(n, edges, directed=directed,
+      seed=1, return_stats=True)
+    assert stats['num_swaps'] > 0
+    assert stats['num_steps'] == 4*len(edges)
+    assert new.shape == edges.shape
+    # Degrees are preserved
+    if directed:
+        for j in range(2):
+            assert (np.bincount(new[:, j], minlength=n) ==
+              np.bincount(edges[:, j], minlength=n)).all()
+        keys = set(map(tuple, new.tolist()))
+    else:
+        assert (np.bincount(new.ravel(), minlength=n) ==
+          np.bincount(edges.ravel(), minlength=n)).all()
+        keys = set(tuple(sorted(e)) for e in new.tolist())
+    # No loops or multiple edges
+    assert (new[:, 0] != new[:, 1]).all()
+    assert len(keys) == len(new)
+    # Seeded runs are reproducible
+    assert (gd.maslov_sneppen_edges(n, edges, directed=directed,
+      seed=1) == new).all()
+
+def test_maslov_sneppen_compiled_graph():
+    G = gd.compile_edges(40, random_edges(40, 0.15, loops=False,
+      rng=np.random.RandomState(4)))
+    H = gd.maslov_sneppen(G, seed=2)
+    assert isinstance(H, gd.CompiledGraph)
+    assert (H.in_degrees() == G.in_degrees()).all()
+
+
+def test_preferential_attachment():
+    n, m = 200, 3
+    bias = {'green': 0.5, 'red': 0.5}
+    edges, codes, palette = gd.preferential_attachment_edges(n, bias, m=m,
+      seed=1)
+    assert len(edges) == m*(m + 1)//2 + (n - m - 1)*m
+    assert (edges[:, 0] != edges[:, 1]).all()
+    assert len(set(tuple(sorted(e)) for e in edges.tolist())) == len(edges)
+    assert len(codes) == n and set(palette) == set(bias)
+    G, coloring = gd.preferential_attachment(n, bias, m=m, seed=1,
+      output='compiled')
+    assert G.num_verts() == n and G.num_edges() == len(edges)
+    assert coloring == gd.decode_coloring(G, codes, palette)
+    again = gd.preferential_attachment_edges(n, bias, m=m, seed=1)
+    assert (again[0] == edges).all() and (again[1] == codes).all()
+    # With full homophily each new vertex copies its first neighbor's color
+    edges, codes, palette = gd.preferential_attachment_edges(n, bias, m=m,
+      homophily=1, seed=2)
+    first = edges[m*(m + 1)//2::m]
+    assert (first[:, 0] == np.arange(m + 1, n)).all()
+    assert (codes[first[:, 0]] == codes[first[:, 1]]).all()
+    result = gd.run_rule_many_times(gd.plurality_rule, {},
+      gd.preferential_attachment, {'num_verts': 30, 'bias': bias, 'm': 2,
+      'output': 'compiled'}, None, None, num_steps=10, num_runs=5, seed=1,
+      print_stats=False)
+    assert result[0] == 5
+
+
+# Graph backends -------------------------------------------------------------
+def neighbor_lists(G):
+    r"""
+    Return the dictionary of the sorted lists of in-neighbors of the
+    vertices of the given compiled graph.
+    """
+    return {v: sorted(G.neighbor_in_iterator(v)) for v in G.vertex_iterator()}
+
+def backend_graphs():
+    rng = np.random.RandomState(5)
+    for directed in [False, True]:
+        yield gd.compile_edges(15, random_edges(15, 0.2, directed, rng=rng),
+          directed)
+    yield gd.triangular_lattice(4, 3, output='compiled')
+
+def test_networkx_round_trip():
+    nx = pytest.importorskip('networkx')
+    for G in backend_graphs():
+        N = gd.to_networkx(G)
+        assert isinstance(N, nx.DiGraph if G.is_directed() else nx.Graph)
+        assert N.number_of_edges() == G.num_edges()
+        H = gd.compile_graph(N)
+        assert H.is_directed() == G.is_directed()
+        assert H.vertices() == G.vertices()
+        assert neighbor_lists(H) == neighbor_lists(G)
+        assert H.get_pos() == G.get_pos()
+        assert gd.to_networkx(N) is N
+    # The rules compile NetworkX graphs on the way in
+    G = gd.moore_lattice(4, 5, output='compiled')
+    coloring = gd.color_randomly(G, {'a': 0.5, 'b': 0.5}, seed=6)
+    N = gd.moore_lattice(4, 5, output='networkx')
+    assert gd.plurality_rule(N, coloring) ==\
+      gd.plurality_rule(gd.from_networkx(N), coloring)
+
+def test_scipy_sparse_round_trip():
+    sp = pytest.importorskip('scipy.sparse')
+    rng = np.random.RandomState(7)
+    for directed in [False, True]:
+        edges = random_edges(15, 0.2, directed, rng=rng)
+        A = sp.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])),
+          shape=(15, 15))
+        G = gd.from_scipy_sparse(A, directed=directed)
+        expected = gd.compile_edges(15, edges, directed)
+        assert neighbor_lists(G) == neighbor_lists(expected)
+        assert G.num_edges() == len(edges)
+        H = gd.from_scipy_sparse(A.tocsr(), directed=directed,
+          labels='abcdefghijklmno')
+        assert sorted(H.neighbor_in_iterator('a')) ==\
+          ['abcdefghijklmno'[i] for i in G.neighbor_in_iterator(0)]
+    # Undirected graphs need only the upper triangle
+    G = gd.compile_graph(sp.csr_matrix(np.triu(np.ones((4, 4)), 1)))
+    assert neighbor_lists(G) == {0: [1, 2, 3], 1: [0, 2, 3], 2: [0, 1, 3],
+      3: [0, 1, 2]}
+
+def test_sage_round_trip():
+    pytest.importorskip('sage.graphs.graph')
+    for G in backend_graphs():
+        S = gd.to_sage(G)
+        assert S.is_directed() == G.is_directed()
+        assert S.num_edges() == G.num_edges()
+        H = gd.compile_graph(S)
+        assert sorted(H.vertices()) == sorted(G.vertices())
+        assert neighbor_lists(H) == neighbor_lists(G)
+        assert gd.to_sage(S) is S
+
+
+# Edge lists -----------------------------------------------------------------
+@pytest.mark.parametrize('directed', [False, True])
+def test_load_edge_list(tmp_path, directed):
+    rng = np.random.RandomState(5)
+    edges = rng.randint(20, size=(300, 2))*3 + 1
+    labels = sorted(set(edges.ravel().tolist()))
+    numbers = np.searchsorted(labels, edges)
+    expected = gd.compile_edges(len(labels), numbers, directed)
+    text = tmp_path / 'edges.txt'
+    with open(str(text), 'w') as f:
+        f.write('# comment\n\n')
+        for a, b in edges.tolist():
+            f.write('%d %d\n' % (a, b))
+    binary = tmp_path / 'edges.bin'
+    edges.astype('<i4').tofile(str(binary))
+    for path, kwargs in [(text, {}), (text, {'chunk_size': 7}),
+      (binary, {'format': 'binary', 'dtype': '<i4', 'chunk_size': 11})]:
+        G = gd.load_edge_list(str(path), directed=directed, **kwargs)
+        assert list(G.labels) == labels
+        assert (G.indptr == expected.indptr).all()
+        assert (G.indices == expected.indices).all()
+
+def test_edge_order(tmp_path):
+    edges = [[0, 1], [2, 0], [0, 3]]
+    G = gd.compile_edges(4, edges)
+    assert list(G.neighbor_iterator(0)) == [1, 2, 3]
+    path = str(tmp_path / 'edges.txt')
+    with open(path, 'w') as f:
+        f.write('0 1\n2 0\n0 3\n')
+    H = gd.load_edge_list(path)
+    assert (G.indptr == H.indptr).all() and (G.indices == H.indices).all()
+
+def test_load_edge_list_string_labels(tmp_path):
+    path = str(tmp_path / 'edges.csv')
+    with open(path, 'w') as f:
+        f.write('b,a,1\nc,b,2\nb,d,3\n')
+    G = gd.load_edge_list(path, label_type=str, delimiter=',', chunk_size=2)
+    assert list(G.labels) == ['b', 'a', 'c', 'd']
+    assert sorted(G.neighbor_iterator('b')) == ['a', 'c', 'd']
+
+
+# Many runs ------------------------------------------------------------------
+GSL3_ARGS = (gd.gsl3_rule, {'T': 0.5, 't': 0.3, 's': 0.2}, random_graph,
+  {'n': 20, 'p': 0.2}, gd.color_randomly,
+  {'bias': {'green': 0.4, 'red': 0.4, 'yellow': 0.2}})
+
+def test_run_rule_many_times_in_parallel():
+    from concurrent.futures import ProcessPoolExecutor
+
+    serial = gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=30,
+      seed=1, print_stats=False)
+    assert serial[0] > 0
+    assert gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=30,
+      seed=1, print_stats=False) == serial
+    assert gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=30,
+      seed=1, print_stats=False, num_workers=2, chunk_size=4) == serial
+    with ProcessPoolExecutor(2) as executor:
+        assert gd.run_rule_many_times(*GSL3_ARGS, num_steps=20,
+          num_runs=30, seed=1, print_stats=False, executor=executor) ==\
+          serial
+
+def test_run_stats():
+    values = np.random.RandomState(9).random_sample(50)
+    welford = gd._Welford()
+    for x in values:
+        welford.add(x)
+    assert welford.count == 50 and np.isclose(welford.mean, values.mean())
+    assert np.isclose(welford.variance(), values.var(ddof=1))
+    assert np.isclose(welford.std_error(), values.std(ddof=1)/np.sqrt(50))
+
+def test_run_rule_many_times_stats():
+    result = gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=30,
+      seed=1, print_stats=False, return_stats=True)
+    stats = result[4]
+    assert stats.num_runs == 30 and result[0] == stats.num_stabilized
+    assert result[1] == stats.steps.mean
+    assert result[2] == stats.mean_color_counts(final=False)
+    assert result[3] == stats.mean_color_counts()
+    assert result[:4] == stats.summary()
+    assert sum(stats.steps_histogram.values()) == stats.num_stabilized
+    assert set(stats.half_widths()) == {'green', 'red', 'yellow'}
+    in_parallel = gd.run_rule_many_times(*GSL3_ARGS, num_steps=20,
+      num_runs=30, seed=1, print_stats=False, num_workers=2)
+    assert in_parallel == result[:4]
+
+def test_run_rule_many_times_stops_early():
+    stats = gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=1000,
+      seed=1, print_stats=False, precision=20, check_every=10,
+      return_stats=True)[4]
+    assert stats.num_runs == 10
+    stats = gd.run_rule_many_times(*GSL3_ARGS, num_steps=20, num_runs=40,
+      seed=1, print_stats=False, precision=1e-9, check_every=10,
+      return_stats=True)[4]
+    assert stats.num_runs == 40
+
+num_generated = [0]
+
+def counted_random_graph(**kwargs):
+    num_generated[0] += 1
+    return random_graph(**kwargs)
+
+def test_sweep_caching(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    args = (gd.gsl3_rule, {'T': [0.5, 0.6], 't': [0.3], 's': [0.2]},
+      counted_random_graph, {'n': [15, 20], 'p': [0.2]}, gd.color_randomly,
+      {'bias': [{'green': 0.4, 'red': 0.4, 'yellow': 0.2}]})
+    num_generated[0] = 0
+    cells = gd.sweep(*args, num_steps=20, num_runs=10, seed=3,
+      cache_dir=cache_dir)
+    assert len(cells) == 4 and len(os.listdir(cache_dir)) == 4
+    # Each graph serves all update rule kwargs
+    assert num_generated[0] == 2*10
+    for urk, ggk, cfk, stats in cells:
+        assert stats.summary() == gd.run_rule_many_times(gd.gsl3_rule, urk,
+          random_graph, ggk, gd.color_randomly, cfk, num_steps=20,
+          num_runs=10, seed=3, print_stats=False)
+    # A repeated sweep loads every cell from the cache
+    again = gd.sweep(*args, num_steps=20, num_runs=10, seed=3,
+      cache_dir=cache_dir)
+    assert num_generated[0] == 2*10
+    assert [cell[3].summary() for cell in again] ==\
+      [cell[3].summary() for cell in cells]
+    # An extended sweep computes only the new cells
+    args[1]['T'].append(0.7)
+    extended = gd.sweep(*args, num_steps=20, num_runs=10, seed=3,
+      cache_dir=cache_dir)
+    assert len(extended) == 6 and num_generated[0] == 2*10 + 2*10
+    assert len(os.listdir(cache_dir)) == 6
+    in_parallel = gd.sweep(*args, num_steps=20, num_runs=10, seed=3,
+      num_workers=2)
+    assert [cell[3].summary() for cell in in_parallel] ==\
+      [cell[3].summary() for cell in extended]
+
+def test_cache_keys_of_functions():
+    import functools
+
+    key = gd._cache_key
+    f, g = (lambda x: x + 1), (lambda x: x + 2)
+    assert key(f) != key(g)
+
+    def adder(k):
+        return lambda x: x + k
+
+    assert key(adder(1)) != key(adder(2))
+    assert key(adder(1)) == key(adder(1))
+    partial = functools.partial(random_graph, 10, directed=True)
+    assert key(partial) == key(functools.partial(random_graph, 10,
+      directed=True))
+    assert key(partial) != key(functools.partial(random_graph, 11,
+      directed=True))
+    assert key(gd.gsl3_rule) == key(gd.gsl3_rule) != key(gd.gsl2_rule)
+
+def given_graph(graph):
+    return graph
+
+def test_cache_keys_of_arrays_and_graphs(tmp_path):
+    key = gd._cache_key
+    a = np.arange(5000)
+    b = a.copy()
+    b[2500] = -1
+    # The reprs of a and b are equal, since NumPy truncates them
+    assert repr(a) == repr(b) and key(a) != key(b)
+    assert key(a) == key(a.copy()) != key(a.astype(np.int32))
+    assert key(np.float64(0.5)) == key(0.5)
+    moore = gd.moore_lattice(5, 5, output='compiled')
+    triangular = gd.triangular_lattice(5, 5, output='compiled')
+    assert repr(moore) == repr(triangular)
+    assert key(moore) != key(triangular)
+    assert key(moore) == key(gd.moore_lattice(5, 5, output='compiled'))
+    with pytest.raises(TypeError):
+        key({'x': object()})
+    # Each graph gets its own cache file
+    cache_dir = str(tmp_path / 'cache')
+    cells = gd.sweep(gd.majority_rule, {}, given_graph,
+      {'graph': [moore, triangular]}, gd.color_randomly,
+      {'bias': [{'a': 0.5, 'b': 0.5}]}, num_steps=5, num_runs=4,
+      cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
+    for urk, ggk, cfk, stats in cells:
+        assert stats.summary() == gd.run_rule_many_times(gd.majority_rule,
+          {}, given_graph, ggk, gd.color_randomly, cfk, num_steps=5,
+          num_runs=4, seed=0, print_stats=False)
+    with pytest.raises(TypeError):
+        gd.sweep(gd.majority_rule, {}, given_graph, {'graph': [object()]},
+          gd.color_randomly, {'bias': [{'a': 0.5, 'b': 0.5}]},
+          cache_dir=cache_dir)
+
+def test_instrument():
+    G = random_graph(30, 0.2)
+    c = gd.color_randomly(G, {'a': 0.5, 'b': 0.5}, seed=2)
+    # Changes are counted on Colorings, dictionaries, and incrementally
+    for graph, incremental in [(G, False), (SageLikeGraph(G), False),
+      (G, True)]:
+        instrument = gd.Instrument(memory=True)
+        s, stabilized = gd.run_rule(gd.majority_rule, {}, graph, c,
+          num_steps=10, incremental=incremental, instrument=instrument)
+        records = instrument.sink.records
+        steps = [r for r in records if r['event'] == 'step']
+        assert [r['num_changed'] for r in steps[:len(s) - 1]] ==\
+          [sum(a[v] != b[v] for v in a) for a, b in zip(s, s[1:])]
+        assert records[-1]['event'] == 'run'
+        assert records[-1]['num_steps'] == len(s) - 1
+    # A coloring function may be given without kwargs
+    instrument = gd.Instrument(steps=False)
+    gd.run_rule_many_times(gd.majority_rule, {}, random_graph,
+      {'n': 30, 'p': 0.2}, lambda G: c, None, num_steps=5, num_runs=2,
+      seed=0, print_stats=False, instrument=instrument)
+    assert [r['event'] for r in instrument.sink.records] == ['run']*2 +\
+      ['summary']
+
+def test_instrument_profile_hook():
+    import contextlib
+
+    G = random_graph(30, 0.2)
+    c = gd.color_randomly(G, {'a': 0.5, 'b': 0.5}, seed=2)
+    steps = []
+
+    def profile(step):
+        steps.append(step)
+        return contextlib.nullcontext()
+
+    instrument = gd.Instrument(steps=False, profile=profile)
+    s, stabilized = gd.run_rule(gd.majority_rule, {}, G, c, num_steps=10,
+      instrument=instrument)
+    assert steps == list(range(1, len(steps) + 1))
+    assert len(steps) >= len(s) - 1
+    assert [r['event'] for r in instrument.sink.records] == ['run']
+
+def test_json_lines_sink(tmp_path):
+    import io
+    import json
+
+    path = str(tmp_path / 'records.jsonl')
+    kwargs = dict(num_steps=20, num_runs=6, seed=1, print_stats=False)
+    instrument = gd.Instrument(gd.JsonLinesSink(path), steps=False)
+    result = gd.run_rule_many_times(*GSL3_ARGS, instrument=instrument,
+      **kwargs)
+    instrument.close()
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['event'] for r in records] == ['run']*6 + ['summary']
+    assert [r['run'] for r in records[:-1]] == list(range(6))
+    assert records[-1]['num_stabilized'] == result[0]
+    assert records[-1]['num_runs'] == 6
+    # Worker processes return their records to be emitted in run order
+    stream = io.StringIO()
+    instrument = gd.Instrument(gd.JsonLinesSink(stream), steps=False)
+    gd.run_rule_many_times(*GSL3_ARGS, instrument=instrument, num_workers=2,
+      **kwargs)
+    instrument.close()
+    in_parallel = [json.loads(line) for line in
+      stream.getvalue().splitlines()]
+    assert [(r['event'], r.get('run'), r.get('num_steps')) for r in
+      in_parallel] == [(r['event'], r.get('run'), r.get('num_steps')) for r
+      in records]
+
+
+# Trajectory files -----------------------------------------------------------
+@pytest.mark.parametrize('mode', ['full', 'delta'])
+def test_trajectory_writer_and_reader(tmp_path, mode):
+    path = str(tmp_path / 'trajectory')
+    kwargs = {'T': 0.5, 't': 0.3, 's': 0.2}
+    G = random_graph(40, 0.1)
+    c = gd.color_randomly(G, {'green': 0.4, 'red': 0.4, 'yellow': 0.2},
+      seed=4)
+    s, stabilized = gd.run_rule(gd.gsl3_rule, kwargs, G, c, num_steps=20)
+    with gd.TrajectoryWriter(path, G, mode=mode, update_rule=gd.gsl3_rule,
+      update_rule_kwargs=kwargs, keyframe_every=3) as writer:
+        gd.run_rule(gd.gsl3_rule, kwargs, G, c, num_steps=20,
+          record='final', callback=writer)
+    reader = gd.TrajectoryReader(path)
+    assert len(reader) == len(s)
+    assert list(reader) == s and reader[-1] == s[-1]
+    assert reader.update_rule == 'graph_dynamics.gsl3_rule'
+    assert reader.update_rule_kwargs == kwargs
+    assert list(reader.labels) == list(G.labels)
+    codes = [reader.codes(i).copy() for i in range(len(reader))]
+    assert all((a == b).all() for a, b in zip(reader.iter_codes(), codes))
+    if mode == 'full':
+        assert (reader.array() == np.array(codes)).all()
+    reader.close()
+
+    # Resume after a crash in the middle of the last coloring
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+    writer = gd.TrajectoryWriter(path, resume=True)
+    assert len(writer) == len(s) - 1
+    assert writer.last_coloring() == s[-2]
+    gd.run_rule(gd.gsl3_rule, kwargs, G, writer.last_coloring(),
+      num_steps=20, record='final', callback=writer)
+    writer.close()
+    reader = gd.TrajectoryReader(path)
+    assert list(reader) == s
+    reader.close()
+
+@pytest.mark.parametrize('mode', ['full', 'delta'])
+def test_trajectory_writer_appends_after_close(tmp_path, mode):
+    path = str(tmp_path / 'trajectory')
+    G = random_graph(10, 0.3)
+    rng = np.random.RandomState(6)
+    colorings = [random_coloring(G, ['a', 'b'], rng) for _ in range(6)]
+    writer = gd.TrajectoryWriter(path, G, palette=['a', 'b'], mode=mode,
+      keyframe_every=2)
+    writer.append(colorings[0])
+    writer.append(colorings[1])
+    writer.close()
+    writer.append(colorings[2])
+    writer.close()
+    # A resumed writer also appends after close
+    writer = gd.TrajectoryWriter(path, resume=True)
+    writer.append(colorings[3])
+    writer.close()
+    writer.append(colorings[4])
+    writer.append(colorings[5])
+    writer.close()
+    reader = gd.TrajectoryReader(path)
+    assert list(reader) == colorings
+    reader.close()
+
+
+# Colorings ------------------------------------------------------------------
+def test_coloring_behaves_as_dictionary():
+    G = gd.compile_edges(3, [[0, 1], [1, 2]])
+    c = gd.Coloring(G, np.array([0, 1, 0]), ['green', 'red'])
+    d = {0: 'green', 1: 'red', 2: 'green'}
+    assert c == d and d == c and dict(c) == d
+    assert c[1] == 'red' and 1 in c and 3 not in c
+    assert c.counts() == {'green': 2, 'red': 1}
+    assert c != {0: 'green', 1: 'green', 2: 'green'}
+    assert gd.Coloring.from_dict(G, d) == c
+    assert hash(gd.Coloring.from_dict(G, d)) == hash(c)
+    assert c.inverted() == gd.invert_dict(d) == {'green': {0, 2}, 'red': {1}}
+    assert {k: m.tolist() for k, m in c.masks().items()} ==\
+      {'green': [True, False, True], 'red': [False, True, False]}
+    assert c.codes.dtype == np.uint8 and not c.codes.flags.writeable
+    # Equal palettes are stored once
+    assert gd.Coloring(G, [1, 1, 0], ['green', 'red']).palette is c.palette
+    codes, palette = gd.encode_coloring(G, c)
+    assert codes.tolist() == [0, 1, 0] and list(palette) == ['green', 'red']
+
+def test_coloring_equality_ignores_unused_colors():
+    G = gd.compile_edges(3, [[0, 1], [1, 2]])
+    a = gd.Coloring(G, [0, 1, 0], ['green', 'red'])
+    b = gd.Coloring(G, [0, 1, 0], ['green', 'red', 'yellow'])
+    c = gd.Coloring(G, [2, 0, 2], ['red', 'yellow', 'green'])
+    for x, y in [(a, b), (a, c), (b, c)]:
+        assert x == y and y == x
+        assert not x != y and not y != x
+        assert hash(x) == hash(y)
+    d = gd.Coloring(G, [0, 1, 1], ['green', 'red', 'yellow'])
+    e = gd.Coloring(G, [0, 1, 2], ['green', 'red', 'yellow'])
+    for x in [a, b, c]:
+        assert x != d and d != x
+        assert x != e and e != x
+    # A decoded update compares equal to the update itself
+    G = random_graph(30, 0.2)
+    new = gd.gsl3_rule(G, gd.color_randomly(G, {'green': 0.5, 'red': 0.5},
+      seed=1))
+    assert gd.Coloring.from_dict(G, dict(new)) == new
+    assert new == gd.Coloring.from_dict(G, dict(new))